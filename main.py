@@ -1,27 +1,859 @@
 # -*- coding: utf-8 -*-
 
+import time
+MODULE_START = time.perf_counter()  # Before other imports, so profiles can show import cost
+
 import sys
 import json
 import webbrowser
 import urllib.parse
 import requests
 import base64
+import hashlib
+import secrets
 import os
 import subprocess
 import platform
-import time
+import types
 import threading
+import socket
 import http.server
-import socketserver
+import cProfile
+import difflib
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from urllib.parse import urlparse, parse_qs
 
+IMPORTS_DONE = time.perf_counter()
+
+# Short connect timeout so a dead network is detected quickly
+CONNECT_TIMEOUT = 1.5
+READ_TIMEOUT = 5
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# OAuth callback listener lifetime
+AUTH_TIMEOUT = 120
+
+# Offline handling
+OFFLINE_RETRY_SECONDS = 15  # Skip the network this long after a failure
+MAX_PENDING_ACTIONS = 50
+
+# In-process caches: global cap plus (byte budget, retention) per namespace.
+# The cap is below the sum of the budgets, so namespaces compete for it, but
+# any single namespace plus the small ones fits, so one full namespace never
+# evicts everything else.
+MAX_CACHE_BYTES = 3584 * 1024
+CACHE_NAMESPACES = {
+    "search": (768 * 1024, 7 * 24 * 3600),
+    "devices": (16 * 1024, 24 * 3600),
+    "player": (4 * 1024, 3600),
+    "tokens": (4 * 1024, 3600),
+    "library": (3 * 1024 * 1024, 30 * 24 * 3600)
+}
+# Large namespaces kept in their own file, loaded only when used
+SEPARATE_CACHE_NAMESPACES = ("library",)
+# Events that invalidate cached namespaces
+CACHE_INVALIDATION = {
+    "authorized": ("devices", "player"),
+    "token_refreshed": ("devices", "player"),
+    "device_changed": ("player",)
+}
+
+# Playlist and library browsing
+ACTION_KEYWORD = "sp"
+PAGE_CONCURRENCY = 4  # Parallel page requests, keeps us inside the rate limit
+MAX_PAGE_RETRIES = 2
+MAX_PAGED_ITEMS = 10000
+MAX_BROWSE_RESULTS = 100
+PLAYLISTS_TTL = 300
+LIBRARY_TTL = 300
+PLAYLIST_TRACK_FIELDS = "total,items(track(type,name,uri,duration_ms,artists(name),album(name,images)))"
+
+# Ranking of the merged general search results
+RANK_CANDIDATES = 10  # Items fetched per type before ranking
+RANK_TOP_K = 10
+RANK_WEIGHTS = {
+    "similarity": 1.0,   # Fuzzy match of query against the item name
+    "coverage": 0.6,     # Share of query words found in title and subtitle
+    "exact": 0.8,        # Name equals the query
+    "prefix": 0.3,       # Name starts with the query
+    "popularity": 0.4,   # Spotify popularity, 0-100; skipped when unknown (albums)
+    "history": 0.8       # Personal play history
+}
+# Small tie-breaker so tracks lead when scores are equal
+RANK_TYPE_PRIOR = {"play_track": 0.008, "play_artist": 0.005, "play_album": 0.003}
+
+# Usage history and prefetch
+SEARCH_TTL = 600  # Serve cached searches without the network this long
+PREFETCH_INTERVAL = 300
+PREFETCH_TOP_N = 10
+HISTORY_HALF_LIFE = 7 * 24 * 3600
+MAX_HISTORY_ENTRIES = 500
+
+# Profiling: set SPOTIFY_PLUGIN_PROFILE=1 (spans) or =cprofile (spans + pstats)
+PROFILE_ENV = "SPOTIFY_PLUGIN_PROFILE"
+MAX_PROFILE_TRACES = 50
+
+# Coordination between concurrent plugin processes
+COALESCE_WINDOW = 1.0  # Reuse another process's identical response this long
+COALESCE_WAIT = CONNECT_TIMEOUT + READ_TIMEOUT  # Longest wait for the process doing the work
+COALESCE_POLL = 0.02
+LOCK_STALE = 15  # Locks older than this belong to a dead process
+SPOTIFY_CHECK_WINDOW = 2
+
+# Compact JSON output: no whitespace, static envelope precomputed
+JSON_SEPARATORS = (",", ":")
+RESULT_PREFIX = '{"result":'
+RESULT_SUFFIX = '}'
+
+def emit_results(results):
+    """Print results in the JSON-RPC envelope Flow Launcher expects"""
+    print(RESULT_PREFIX + json.dumps(results, separators=JSON_SEPARATORS) + RESULT_SUFFIX)
+
+class OfflineError(requests.exceptions.ConnectionError):
+    """Raised instead of hitting the network while marked offline"""
+
+def acquire_lock(path, timeout=0.5):
+    """Create lock file exclusively, waiting up to timeout. Returns True if held."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > LOCK_STALE:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+        except OSError:
+            return False
+
+        if time.time() >= deadline:
+            return False
+        time.sleep(COALESCE_POLL)
+
+def release_lock(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_json_atomic(path, data):
+    """Atomically write compact JSON, returning True on success"""
+    try:
+        temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, separators=JSON_SEPARATORS)
+        os.replace(temp_file, path)
+        return True
+    except:
+        return False
+
+class RequestCoalescer:
+    """Share in-flight work between concurrent plugin processes.
+
+    The first process to claim a key creates <key>.lock, does the work and
+    publishes the result as <key>.json. Processes that find the lock wait
+    for that result instead of repeating the work, and results stay
+    reusable for a short window after they land.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def make_key(self, *parts):
+        """Stable key for JSON serialisable parts"""
+        raw = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def read_result(self, path, since):
+        try:
+            with open(path, 'r') as f:
+                result = json.load(f)
+            return result if result["time"] >= since else None
+        except:
+            return None
+
+    def run(self, key, producer, window=COALESCE_WINDOW, wait=COALESCE_WAIT, keep_result=True):
+        """Return producer() or the value another process produced for key.
+
+        With keep_result False the result is only handed to processes already
+        waiting and deleted right after, for values that must not linger on disk.
+        Raises OfflineError when the producing process failed to connect.
+        """
+        lock_path = os.path.join(self.directory, key + ".lock")
+        result_path = os.path.join(self.directory, key + ".json")
+
+        result = self.read_result(result_path, time.time() - window)
+        if result is None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                result = self.wait_for_result(lock_path, result_path, wait)
+                if result is None:
+                    return producer()
+            except OSError:
+                return producer()
+            else:
+                return self.produce(lock_path, result_path, producer, keep_result)
+
+        if "error" in result:
+            raise OfflineError(result["error"])
+        return result["value"]
+
+    def wait_for_result(self, lock_path, result_path, wait):
+        """Wait for the lock holder's result; None if it vanished or timed out"""
+        try:
+            started = os.path.getmtime(lock_path)
+        except OSError:
+            started = time.time()
+        if time.time() - started > LOCK_STALE:
+            release_lock(lock_path)
+            return None
+
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            time.sleep(COALESCE_POLL)
+            result = self.read_result(result_path, started - COALESCE_POLL)
+            if result is not None:
+                return result
+            if not os.path.exists(lock_path):
+                return self.read_result(result_path, started - COALESCE_POLL)
+        return None
+
+    def produce(self, lock_path, result_path, producer, keep_result=True):
+        try:
+            try:
+                value = producer()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                write_json_atomic(result_path, {"time": time.time(), "error": str(e)})
+                raise
+            write_json_atomic(result_path, {"time": time.time(), "value": value})
+            return value
+        finally:
+            release_lock(lock_path)
+            if not keep_result:
+                # Waiters poll every COALESCE_POLL; give them a few polls to read it
+                time.sleep(COALESCE_POLL * 3)
+                try:
+                    os.remove(result_path)
+                except OSError:
+                    pass
+            self.prune()
+
+    def prune(self):
+        """Remove results too old to be reused"""
+        try:
+            now = time.time()
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith((".json", ".tmp")) and now - os.path.getmtime(path) > LOCK_STALE:
+                    os.remove(path)
+        except OSError:
+            pass
+
+class SharedResponse:
+    """Response rebuilt from a result shared between processes"""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.content)
+
+class Tracer:
+    """Wall-clock span recorder writing Chrome trace JSON.
+
+    Only created when profiling is enabled; instrumented functions are
+    replaced on the class, so disabled runs pay nothing beyond one check.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.events = []
+        self.pid = os.getpid()
+        self.label = "query"
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        self.span("import", MODULE_START, IMPORTS_DONE)
+        if self.profiler:
+            self.profiler.enable()
+
+    def span(self, name, start, end, args=None):
+        """Record a complete event; times are perf_counter seconds"""
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - MODULE_START) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": self.pid,
+            "tid": threading.get_ident()
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def wrap(self, func, name):
+        """Return func recording a span per call"""
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.span(name, start, time.perf_counter())
+        traced.__name__ = func.__name__
+        traced.__doc__ = func.__doc__
+        return traced
+
+    def instrument(self, cls):
+        """Trace every plain method of cls"""
+        for name, attr in list(vars(cls).items()):
+            if isinstance(attr, types.FunctionType) and not name.startswith("__"):
+                setattr(cls, name, self.wrap(attr, f"{cls.__name__}.{name}"))
+
+    def finish(self, start):
+        """Record the main span and write traces to the profile directory"""
+        if self.profiler:
+            self.profiler.disable()
+        self.span("main", start, time.perf_counter(), {"method": self.label})
+
+        try:
+            profile_dir = get_profile_dir()
+            os.makedirs(profile_dir, exist_ok=True)
+            stem = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.pid}-{self.label}")
+            with open(stem + ".trace.json", 'w') as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f, separators=JSON_SEPARATORS)
+            if self.profiler:
+                self.profiler.dump_stats(stem + ".pstats")
+            prune_profiles(profile_dir)
+        except:
+            pass
+
+def get_profile_dir():
+    """Get directory for profiling traces"""
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(plugin_dir, "spotify_profiles")
+
+def get_profile_mode():
+    """Profiling mode from the environment or the 'sp debug profile' toggle"""
+    mode = os.environ.get(PROFILE_ENV, "").strip().lower()
+    if mode in ("", "0", "false", "off"):
+        mode = "trace" if os.path.exists(os.path.join(get_profile_dir(), "enabled")) else ""
+    return mode
+
+def prune_profiles(profile_dir):
+    """Keep only the newest traces"""
+    files = [os.path.join(profile_dir, name) for name in os.listdir(profile_dir)
+             if name.endswith((".trace.json", ".pstats"))]
+    files.sort(key=os.path.getmtime, reverse=True)
+    for path in files[MAX_PROFILE_TRACES:]:
+        os.remove(path)
+
+def start_profiling():
+    """Instrument the plugin when profiling is enabled, else return None"""
+    mode = get_profile_mode()
+    if not mode:
+        return None
+
+    tracer = Tracer(mode)
+    tracer.instrument(SpotifyPlugin)
+    globals()["emit_results"] = tracer.wrap(emit_results, "emit_results")
+    return tracer
+
+class AuthCallbackHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the OAuth redirect for AuthCallbackServer"""
+
+    def do_GET(self):
+        parsed_url = urlparse(self.path)
+        if parsed_url.path != self.server.callback_path:
+            self.send_page(404, b"<h1>Not Found</h1>")
+            return
+
+        query_params = parse_qs(parsed_url.query)
+        state = query_params.get("state", [None])[0]
+
+        if state != self.server.expected_state:
+            self.send_page(400, b"<h1>Error!</h1><p>Invalid authorization state.</p>")
+        elif "code" in query_params:
+            if self.server.on_code(query_params["code"][0]):
+                self.server.succeeded = True
+                self.send_page(200, b"<h1>Success!</h1><p>You can close this window.</p>")
+            else:
+                self.send_page(400, b"<h1>Error!</h1><p>Failed to authorize.</p>")
+        else:
+            self.send_page(400, b"<h1>Error!</h1><p>No authorization code received.</p>")
+
+        # Single shot: any callback with our state ends the session
+        if state == self.server.expected_state:
+            self.server.finished.set()
+
+    def send_page(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Suppress logs
+
+class AuthCallbackServer(http.server.HTTPServer):
+    """Single-shot OAuth callback listener with bounded lifetime.
+
+    Binds the host and port of the configured redirect URI, falling back
+    to an ephemeral port when it is taken. Spotify only accepts loopback
+    redirects by IP literal, so localhost is bound as 127.0.0.1. Serves on
+    a background thread until one callback arrives or the timeout expires.
+    """
+
+    # Never share the port: with SO_REUSEADDR Windows lets the bind succeed
+    # while another listener holds it, so the fallback would never trigger
+    allow_reuse_address = False
+
+    def __init__(self, redirect_uri, expected_state, on_code):
+        parsed_uri = urlparse(redirect_uri)
+        self.host = parsed_uri.hostname or "127.0.0.1"
+        if self.host == "localhost":
+            self.host = "127.0.0.1"
+        self.callback_path = parsed_uri.path or "/callback"
+        self.expected_state = expected_state
+        self.on_code = on_code
+        self.succeeded = False
+        self.finished = threading.Event()
+        self.thread = None
+
+        try:
+            super().__init__((self.host, parsed_uri.port or 80), AuthCallbackHandler)
+        except OSError:
+            super().__init__((self.host, 0), AuthCallbackHandler)
+
+    def server_bind(self):
+        """Bind exclusively where the platform supports it (Windows)"""
+        if hasattr(socket, "SO_EXCLUSIVEADDRUSE"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        super().server_bind()
+
+    @property
+    def redirect_uri(self):
+        """Redirect URI for the port actually bound"""
+        return f"http://{self.host}:{self.server_address[1]}{self.callback_path}"
+
+    def start(self):
+        """Serve callbacks on a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, timeout=AUTH_TIMEOUT):
+        """Wait for the callback, then shut down. Returns True on success."""
+        self.finished.wait(timeout)
+        self.stop()
+        return self.succeeded
+
+    def stop(self):
+        """Stop serving and release the port"""
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+class CacheNamespace:
+    """LRU store with retention TTL and a byte budget.
+
+    Entries are [value, stored_at, expires_at, size, last_used]. Values
+    must be JSON serialisable; size is their compact JSON length. Lookup
+    counters and recency ("usage") are stored apart from the entries, so
+    invocations that only read can record them without rewriting entries.
+    """
+
+    def __init__(self, name, max_bytes, ttl, manager=None, data=None, usage=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.manager = manager
+        self.changed = False
+        self.removed = set()  # Keys dropped here, not to be revived by merge()
+        self.cleared_at = 0
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.used = {}  # Last use of keys hit here, not yet merged into usage
+
+        if data:
+            self.evictions = data.get("evictions", 0)
+            now = time.time()
+            for key, entry in data.get("entries", []):
+                if entry[2] > now:
+                    self.entries[key] = entry
+                    self.bytes += entry[3]
+
+        # Files written before usage was split out keep counters with the entries
+        usage = usage or data or {}
+        self.hits = usage.get("hits", 0)
+        self.misses = usage.get("misses", 0)
+        self.apply_usage(usage.get("recent"))
+
+        # Counter values as last read from disk, so merges can add our share
+        self.base_counters = (self.hits, self.misses, self.evictions)
+
+    def get(self, key, max_age=None):
+        """Get cached value, or None if missing, expired or older than max_age"""
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[2] <= now:
+            self.discard(key)
+            entry = None
+
+        # Lookups do not mark the namespace changed, only its usage
+        if self.manager:
+            self.manager.looked_up = True
+        if entry is None or (max_age is not None and now - entry[1] >= max_age):
+            self.misses += 1
+            return None
+
+        entry[4] = now
+        self.entries.move_to_end(key)
+        self.used[key] = now
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store value, evicting least recently used entries over budget.
+
+        Values larger than the namespace budget or the manager's headroom
+        for this namespace are not stored rather than flushing other caches.
+        """
+        self.discard(key)
+        size = len(json.dumps(value, separators=JSON_SEPARATORS))
+        if size > self.max_bytes or (self.manager and size > self.manager.headroom(self)):
+            return
+
+        now = time.time()
+        self.entries[key] = [value, now, now + (ttl or self.ttl), size, now]
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.evict_oldest()
+
+        self.touch()
+        if self.manager:
+            self.manager.enforce_limit()
+
+    def discard(self, key):
+        """Remove key if present"""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[3]
+            self.removed.add(key)
+            self.touch()
+
+    def evict_oldest(self):
+        """Evict the least recently used entry"""
+        key = next(iter(self.entries))
+        self.discard(key)
+        self.evictions += 1
+
+    def oldest_use(self):
+        """Last use time of the least recently used entry"""
+        return self.entries[next(iter(self.entries))][4] if self.entries else None
+
+    def clear(self):
+        """Invalidate all entries"""
+        self.entries.clear()
+        self.bytes = 0
+        self.cleared_at = time.time()
+        self.touch()
+
+    def merge(self, data):
+        """Adopt entries and evictions other processes stored since this one loaded"""
+        data = data or {}
+        hits, misses, base = self.base_counters
+        self.evictions = data.get("evictions", base) + self.evictions - base
+        self.base_counters = (hits, misses, self.evictions)
+
+        now = time.time()
+        for key, entry in data.get("entries", []):
+            current = self.entries.get(key)
+            if entry[2] <= now or entry[1] <= self.cleared_at:
+                continue
+            if current is None and key in self.removed:
+                continue
+            if current is not None:
+                if entry[1] <= current[1]:
+                    current[4] = max(current[4], entry[4])
+                    continue
+                self.bytes -= current[3]
+            self.entries[key] = entry
+            self.bytes += entry[3]
+
+        self.apply_usage(None)
+        while self.bytes > self.max_bytes:
+            self.evict_oldest()
+
+    def apply_usage(self, recent):
+        """Adopt last use times recorded elsewhere, then restore LRU order"""
+        for key, last_used in (recent or {}).items():
+            entry = self.entries.get(key)
+            if entry and last_used > entry[4]:
+                entry[4] = last_used
+        self.entries = OrderedDict(sorted(self.entries.items(), key=lambda item: item[1][4]))
+
+    def merge_usage(self, usage):
+        """Combine lookup counters and recency with those on disk, returning the result"""
+        usage = usage or {}
+        base_hits, base_misses, evictions = self.base_counters
+        self.hits = usage.get("hits", base_hits) + self.hits - base_hits
+        self.misses = usage.get("misses", base_misses) + self.misses - base_misses
+        self.base_counters = (self.hits, self.misses, evictions)
+
+        recent = dict(usage.get("recent") or {})
+        self.apply_usage(recent)
+        for key, last_used in self.used.items():
+            recent[key] = max(last_used, recent.get(key, 0))
+        self.used = {}
+        recent = {key: last_used for key, last_used in recent.items() if key in self.entries}
+        return {"hits": self.hits, "misses": self.misses, "recent": recent}
+
+    def touch(self):
+        self.changed = True
+        if self.manager:
+            self.manager.changed = True
+
+    def stats(self):
+        """Effectiveness counters for this namespace"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def to_dict(self):
+        return {
+            "entries": list(self.entries.items()),
+            "evictions": self.evictions
+        }
+
+class CacheManager:
+    """Namespaced caches sharing a global byte cap and invalidation hooks"""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, data=None, usage=None):
+        self.max_bytes = max_bytes
+        self.namespaces = {}
+        self.hooks = {}
+        self.changed = False
+        self.looked_up = False
+        self.data = data or {}
+        self.usage = usage or {}
+
+    def add_namespace(self, name, max_bytes, ttl, data=None):
+        namespace = CacheNamespace(name, max_bytes, ttl, self, data or self.data.get(name),
+                                   self.usage.get(name))
+        self.namespaces[name] = namespace
+        return namespace
+
+    def __getitem__(self, name):
+        return self.namespaces[name]
+
+    def on(self, event, *names):
+        """Invalidate namespaces whenever event fires"""
+        self.hooks.setdefault(event, set()).update(names)
+
+    def fire(self, event):
+        for name in self.hooks.get(event, ()):
+            self.namespaces[name].clear()
+
+    def total_bytes(self):
+        return sum(namespace.bytes for namespace in self.namespaces.values())
+
+    def headroom(self, namespace):
+        """Largest single value namespace may store: the cap minus the budgets of smaller namespaces"""
+        reserved = sum(other.max_bytes for other in self.namespaces.values()
+                       if other is not namespace and other.max_bytes < namespace.max_bytes)
+        return self.max_bytes - reserved
+
+    def enforce_limit(self):
+        """Evict globally least recently used entries above the memory cap"""
+        while self.total_bytes() > self.max_bytes:
+            candidates = [ns for ns in self.namespaces.values() if ns.entries]
+            min(candidates, key=lambda ns: ns.oldest_use()).evict_oldest()
+
+    def stats(self):
+        """Effectiveness counters for every namespace"""
+        return {name: namespace.stats() for name, namespace in self.namespaces.items()}
+
+    def to_dict(self, names):
+        return {name: self.namespaces[name].to_dict() for name in names if name in self.namespaces}
+
+class UsageHistory:
+    """Frequency and recency of queries and played URIs.
+
+    Each entry keeps an exponentially decayed use count and the time of
+    last use, so one score captures both how often and how recently.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.data.setdefault("queries", {})
+        self.data.setdefault("uris", {})
+
+    def decayed(self, entry, now):
+        score, last_used = entry
+        return score * 0.5 ** ((now - last_used) / HISTORY_HALF_LIFE)
+
+    def record(self, kind, key, now=None):
+        """Count one use of key"""
+        now = now or time.time()
+        entries = self.data[kind]
+        entry = entries.get(key)
+        entries[key] = [(self.decayed(entry, now) if entry else 0) + 1, now]
+        self.trim(kind, now)
+
+    def trim(self, kind, now):
+        """Drop the lowest scored entries beyond MAX_HISTORY_ENTRIES"""
+        entries = self.data[kind]
+        if len(entries) > MAX_HISTORY_ENTRIES:
+            for old_key in self.top(kind, len(entries), now)[MAX_HISTORY_ENTRIES:]:
+                del entries[old_key]
+
+    def merge(self, data):
+        """Adopt entries another process used more recently than this one"""
+        now = time.time()
+        for kind in ("queries", "uris"):
+            entries = self.data[kind]
+            for key, entry in ((data or {}).get(kind) or {}).items():
+                current = entries.get(key)
+                if current is None or entry[1] > current[1]:
+                    entries[key] = entry
+            self.trim(kind, now)
+
+    def score(self, kind, key, now=None):
+        """Current score for key, 0 if never used"""
+        entry = self.data[kind].get(key)
+        return self.decayed(entry, now or time.time()) if entry else 0
+
+    def top(self, kind, n, now=None):
+        """Keys with the highest scores"""
+        now = now or time.time()
+        entries = self.data[kind]
+        return sorted(entries, key=lambda key: self.decayed(entries[key], now), reverse=True)[:n]
+
+class ResultRanker:
+    """Local re-scoring of merged multi-type search results.
+
+    Combines string similarity to the query, exact and prefix matches,
+    the popularity Spotify returns and personal play history into a
+    weighted average over the signals a record has, so a missing
+    popularity (search results carry none for albums) is not a penalty.
+    """
+
+    def __init__(self, history, weights=None, top_k=RANK_TOP_K):
+        self.history = history
+        self.weights = dict(RANK_WEIGHTS, **(weights or {}))
+        self.top_k = top_k
+
+    def normalize(self, text):
+        """Lowercase and drop version suffixes such as ' - Remastered 2011'"""
+        text = text.casefold().split(" - ")[0]
+        text = re.sub(r"[\(\[].*?[\)\]]", " ", text)
+        return " ".join(re.findall(r"\w+", text))
+
+    def score(self, record, query, query_words, now):
+        weights = self.weights
+        name = self.normalize(record.name or record.title)
+        # Exact and prefix are alternatives, so only the larger one counts
+        total = sum(weights.values()) - min(weights["exact"], weights["prefix"])
+
+        score = weights["similarity"] * difflib.SequenceMatcher(None, query, name).ratio()
+        if query_words:
+            words = set(re.findall(r"\w+", f"{record.title} {record.subtitle}".casefold()))
+            found = sum(1 for word in query_words if word in words)
+            # The last word may still be being typed
+            last = query_words[-1]
+            if last not in words and len(last) >= 3 and any(word.startswith(last) for word in words):
+                found += 1
+            score += weights["coverage"] * found / len(query_words)
+        if name == query:
+            score += weights["exact"]
+        elif name.startswith(query):
+            score += weights["prefix"]
+        if record.popularity is None:
+            total -= weights["popularity"]
+        else:
+            score += weights["popularity"] * record.popularity / 100
+
+        # Decayed play count, saturating after a handful of plays
+        plays = self.history.score("uris", record.uri, now)
+        score += weights["history"] * min(plays, 5) / 5
+        return score / (total or 1) + RANK_TYPE_PRIOR.get(record.method, 0)
+
+    def rank(self, records, query):
+        """Return the top_k records, best first"""
+        now = time.time()
+        query = self.normalize(query)
+        query_words = query.split()
+        scored = sorted(records, key=lambda record: -self.score(record, query, query_words, now))
+        return scored[:self.top_k]
+
+class SearchResult:
+    """Slim search result record"""
+    __slots__ = ("title", "subtitle", "icon", "method", "uri", "stale", "query", "name", "popularity")
+
+    def __init__(self, title, subtitle, icon, method, uri, stale=False, query="", name="", popularity=None):
+        self.title = title
+        self.subtitle = subtitle
+        self.icon = icon
+        self.method = method
+        self.uri = uri
+        self.stale = stale
+        self.query = query  # Query that produced the result, recorded on play
+        self.name = name  # Plain item name, used for ranking
+        self.popularity = popularity  # None when Spotify does not report it
+
+    @classmethod
+    def from_row(cls, row, stale=False, query=""):
+        """Rebuild record from a cached row"""
+        title, subtitle, icon, method, uri, *extra = row
+        name, popularity = (extra + ["", None])[:2]
+        return cls(title, subtitle, icon, method, uri, stale, query, name, popularity)
+
+    def to_row(self):
+        """Convert to a compact row for the on-disk cache"""
+        return [self.title, self.subtitle, self.icon, self.method, self.uri, self.name, self.popularity]
+
+    def to_result(self):
+        """Convert to Flow Launcher result dict"""
+        subtitle = f"📴 Offline • {self.subtitle}" if self.stale else self.subtitle
+        return {
+            "Title": self.title,
+            "SubTitle": subtitle,
+            "IcoPath": self.icon,
+            "JsonRPCAction": {
+                "method": self.method,
+                "parameters": [self.uri, self.query] if self.query else [self.uri]
+            }
+        }
+
 class SpotifyPlugin:
     def __init__(self):
         self.client_id = "Enter Your Client ID"
         self.client_secret = "Enter Your Client Secret"
-        self.redirect_uri = "http://localhost:8080/callback"
+        self.redirect_uri = "http://127.0.0.1:8080/callback"
+        self.auth_base_url = "https://accounts.spotify.com"
         self.base_url = "https://api.spotify.com/v1"
+        self.market = ""  # Two-letter market code; empty uses the account's market
 
         # OAuth tokens
         self.access_token = None
@@ -29,6 +861,20 @@ class SpotifyPlugin:
         self.token_expires = None
         self.search_token = None  # For search (client credentials)
 
+        # Offline state, cached responses and queued write actions
+        self.cache_data = None
+        self.cache_dirty = False
+        self.caches = None
+        self.coalescer = None
+        self.revalidation_scheduled = False
+        self.queued_ids = set()  # Actions queued and replayed by this process,
+        self.replayed_ids = set()  # merged with other processes' on flush
+        self.history = None
+        self.playlists_fresh = False  # Playlist list snapshots are current
+        self.active_query = ""
+        self.force_refresh = False  # Bypass fresh cached searches
+        self.rank_top_k = RANK_TOP_K  # Rows shown for the general search
+
         # Load saved tokens
         self.load_tokens()
 
@@ -36,9 +882,374 @@ class SpotifyPlugin:
         self.known_commands = [
             "play", "pause", "next", "previous", "track", "artist", "album",
             "shuffle", "repeat", "volume", "device", "like", "unlike",
-            "queue", "reconnect", "mute", "last", "auth"
+            "queue", "reconnect", "mute", "last", "auth", "debug",
+            "playlist", "library"
         ]
 
+    def get_cache_file_path(self):
+        """Get path for storing offline cache"""
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(plugin_dir, "spotify_cache.json")
+
+    def get_cache(self):
+        """Load persistent plugin state on first use"""
+        if self.cache_data is None:
+            self.cache_data = {}
+            try:
+                with open(self.get_cache_file_path(), 'r') as f:
+                    self.cache_data = json.load(f)
+            except:
+                pass
+            for key, default in (("offline_until", 0), ("last_revalidation", 0), ("last_prefetch", 0),
+                                 ("namespaces", {}), ("pending", []), ("history", {})):
+                self.cache_data.setdefault(key, default)
+        return self.cache_data
+
+    def get_caches(self):
+        """Get the shared cache manager with all namespaces registered"""
+        if self.caches is None:
+            self.caches = CacheManager(MAX_CACHE_BYTES, self.get_cache()["namespaces"],
+                                       self.read_json(self.get_namespace_file_path("usage")))
+            for name, (max_bytes, ttl) in CACHE_NAMESPACES.items():
+                if name not in SEPARATE_CACHE_NAMESPACES:
+                    self.caches.add_namespace(name, max_bytes, ttl)
+            for event, names in CACHE_INVALIDATION.items():
+                self.caches.on(event, *names)
+        return self.caches
+
+    def get_namespace_file_path(self, name):
+        """Get path for a namespace stored in its own file"""
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(plugin_dir, f"spotify_cache_{name}.json")
+
+    def get_library_cache(self):
+        """Get the playlist/library namespace, loading it on first use"""
+        caches = self.get_caches()
+        if "library" not in caches.namespaces:
+            data = None
+            try:
+                with open(self.get_namespace_file_path("library"), 'r') as f:
+                    data = json.load(f)
+            except:
+                pass
+            max_bytes, ttl = CACHE_NAMESPACES["library"]
+            caches.add_namespace("library", max_bytes, ttl, data)
+        return caches["library"]
+
+    def cache_stats(self):
+        """Hit/miss and memory counters for every cache namespace"""
+        self.get_library_cache()
+        return self.get_caches().stats()
+
+    def mark_cache_dirty(self):
+        """Schedule state to be written at the end of this invocation"""
+        self.cache_dirty = True
+
+    def flush_cache(self):
+        """Write state and caches to file if anything changed.
+
+        Invocations that only looked entries up just rewrite the small usage
+        file with their hit/miss counters and last use times.
+        """
+        if self.cache_data is None:
+            return
+        caches_changed = False
+        if self.caches is not None and self.caches.changed:
+            caches_changed = any(namespace.changed for name, namespace in self.caches.namespaces.items()
+                                 if name not in SEPARATE_CACHE_NAMESPACES)
+        separate_changed = self.caches is not None and any(
+            self.caches.namespaces[name].changed for name in SEPARATE_CACHE_NAMESPACES
+            if name in self.caches.namespaces)
+        looked_up = self.caches is not None and self.caches.looked_up
+        if not caches_changed and not separate_changed and not self.cache_dirty and not looked_up:
+            return
+
+        # Other invocations may have written since we loaded: merge under lock
+        lock_path = self.get_cache_file_path() + ".lock"
+        locked = acquire_lock(lock_path)
+        try:
+            usage = {}
+            if self.caches is not None:
+                usage_path = self.get_namespace_file_path("usage")
+                usage = self.read_json(usage_path) or {}
+                for name, namespace in self.caches.namespaces.items():
+                    usage[name] = namespace.merge_usage(usage.get(name))
+
+            written = []
+            if separate_changed:
+                for name in SEPARATE_CACHE_NAMESPACES:
+                    namespace = self.caches.namespaces.get(name)
+                    if namespace and namespace.changed:
+                        path = self.get_namespace_file_path(name)
+                        namespace.merge(self.read_json(path))
+                        if write_json_atomic(path, namespace.to_dict()):
+                            written.append(name)
+                        namespace.changed = False
+
+            if caches_changed or self.cache_dirty:
+                disk = self.read_json(self.get_cache_file_path()) or {}
+                self.merge_pending(disk.get("pending"))
+                self.get_history().merge(disk.get("history"))
+
+                disk_namespaces = disk.get("namespaces", {})
+                shared = []
+                if self.caches is not None:
+                    shared = [name for name in self.caches.namespaces if name not in SEPARATE_CACHE_NAMESPACES]
+                    for name in shared:
+                        self.caches[name].merge(disk_namespaces.get(name))
+                        self.caches[name].changed = False
+                    self.cache_data["namespaces"] = self.caches.to_dict(shared)
+                    self.caches.changed = False
+                else:
+                    self.cache_data["namespaces"] = disk_namespaces
+
+                if write_json_atomic(self.get_cache_file_path(), self.cache_data):
+                    self.cache_dirty = False
+                    written.extend(shared)
+
+            if self.caches is not None:
+                # Recency of namespaces just written now lives in their entries
+                for name in written:
+                    usage[name]["recent"] = {}
+                write_json_atomic(usage_path, usage)
+                self.caches.looked_up = False
+        finally:
+            if locked:
+                release_lock(lock_path)
+
+    def merge_pending(self, disk_pending):
+        """Union queued actions on disk with ours, minus those replayed here"""
+        merged = [action for action in disk_pending or []
+                  if self.action_id(action) not in self.replayed_ids]
+        known = {self.action_id(action) for action in merged}
+        for action in self.get_cache()["pending"]:
+            action_id = self.action_id(action)
+            if action_id in self.queued_ids and action_id not in known and action_id not in self.replayed_ids:
+                merged.append(action)
+        del merged[:-MAX_PENDING_ACTIONS]
+        self.get_cache()["pending"] = merged
+
+    def action_id(self, action):
+        """Identity of a queued action; actions queued before ids existed use their content"""
+        return action.get("id") or json.dumps(action, sort_keys=True)
+
+    def read_json(self, path):
+        """Read JSON file, None if missing or invalid"""
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except:
+            return None
+
+    def get_coalescer(self):
+        """Get coordinator for work shared with concurrent invocations"""
+        if self.coalescer is None:
+            plugin_dir = os.path.dirname(os.path.abspath(__file__))
+            self.coalescer = RequestCoalescer(os.path.join(plugin_dir, "spotify_inflight"))
+        return self.coalescer
+
+    def is_offline(self):
+        """Check cached connectivity failure state"""
+        return time.time() < self.get_cache()["offline_until"]
+
+    def mark_offline(self):
+        """Remember connectivity loss so later calls fail fast"""
+        self.get_cache()["offline_until"] = time.time() + OFFLINE_RETRY_SECONDS
+        self.mark_cache_dirty()
+
+    def mark_online(self):
+        """Clear offline state and replay anything queued while offline"""
+        cache = self.get_cache()
+        if cache["offline_until"]:
+            cache["offline_until"] = 0
+            self.mark_cache_dirty()
+        if cache["pending"]:
+            self.schedule_revalidation()
+
+    def http_request(self, method, url, **kwargs):
+        """Send HTTP request, tracking connectivity state"""
+        # Authorization codes are single use: always try them, never share them
+        auth_code = url == self.get_token_url() and (kwargs.get("data") or {}).get("grant_type") == "authorization_code"
+        if self.is_offline() and not auth_code:
+            raise OfflineError(f"Offline, skipping {url}")
+
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        try:
+            if method == "GET":
+                response = self.coalesced_request(method, url, **kwargs)
+            elif url == self.get_token_url() and not auth_code:
+                # Token results are handed to waiting processes only, never kept
+                response = self.coalesced_request(method, url, window=0, keep_result=False, **kwargs)
+            else:
+                response = requests.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.mark_offline()
+            raise
+
+        self.mark_online()
+        return response
+
+    def coalesced_request(self, method, url, window=COALESCE_WINDOW, keep_result=True, **kwargs):
+        """Send read request, sharing identical in-flight requests across processes"""
+        def send():
+            response = requests.request(method, url, **kwargs)
+            return {
+                "status": response.status_code,
+                "content": response.content.decode("utf-8", "replace"),
+                "headers": {"Retry-After": response.headers.get("Retry-After", "1")}
+            }
+
+        key = self.get_coalescer().make_key(method, url, kwargs.get("params"), kwargs.get("data"),
+                                            (kwargs.get("headers") or {}).get("Authorization"))
+        result = self.get_coalescer().run(key, send, window=window, keep_result=keep_result)
+        return SharedResponse(result["status"], result["content"].encode("utf-8"), result["headers"])
+
+    def schedule_revalidation(self, query_str=""):
+        """Refresh caches and replay queued actions in a detached process"""
+        cache = self.get_cache()
+        if self.revalidation_scheduled or time.time() - cache["last_revalidation"] < OFFLINE_RETRY_SECONDS:
+            return
+
+        self.revalidation_scheduled = True
+        cache["last_revalidation"] = time.time()
+        self.mark_cache_dirty()
+        self.spawn_background("revalidate", [query_str])
+
+    def spawn_background(self, method, parameters):
+        """Run a plugin method in a detached process that outlives this one"""
+        self.flush_cache()
+        request = json.dumps({"method": method, "parameters": parameters})
+        kwargs = {
+            "stdin": subprocess.DEVNULL,
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.DEVNULL,
+            "close_fds": True
+        }
+        if platform.system() == 'Windows':
+            kwargs["creationflags"] = 0x00000008 | 0x00000200  # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+
+        try:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), request], **kwargs)
+            return True
+        except:
+            return False
+
+    def get_history(self):
+        """Get usage history stored in the cache"""
+        if self.history is None:
+            self.history = UsageHistory(self.get_cache()["history"])
+        return self.history
+
+    def schedule_prefetch(self):
+        """Pre-warm caches for likely queries in a detached process"""
+        cache = self.get_cache()
+        if self.is_offline() or time.time() - cache["last_prefetch"] < PREFETCH_INTERVAL:
+            return
+        if not cache["history"].get("queries"):
+            return
+
+        cache["last_prefetch"] = time.time()
+        self.mark_cache_dirty()
+        self.spawn_background("prefetch", [])
+
+    def prefetch(self):
+        """Refresh cached searches for the top queries and the device list"""
+        for query_str in self.get_history().top("queries", PREFETCH_TOP_N):
+            if self.is_offline():
+                return
+            self.query(query_str)
+
+        if self.get_valid_access_token():
+            self.get_available_devices()
+
+    def revalidate(self, query_str=""):
+        """Probe connectivity, replay queued actions and refresh cached search"""
+        self.revalidation_scheduled = True
+        self.force_refresh = True
+        self.get_cache()["offline_until"] = 0
+        self.replay_pending_actions()
+        if query_str:
+            self.query(query_str)
+
+    def send_write_request(self, method, path, params=None, body=None):
+        """Send user write action, queueing it for replay while offline.
+
+        Returns "sent", "queued" or "failed".
+        """
+        access_token = self.get_valid_access_token()
+        # An expired token cannot be refreshed offline; replay gets a fresh one
+        if not access_token and not (self.refresh_token and self.is_offline()):
+            return "failed"
+
+        action = {"id": secrets.token_hex(8), "method": method, "path": path,
+                  "params": params or {}, "body": body}
+        if not access_token:
+            return self.queue_action(action)
+        try:
+            response = self.http_request(method, f"{self.base_url}{path}",
+                                         headers={"Authorization": f"Bearer {access_token}"},
+                                         params=action["params"], json=body)
+            return "sent" if response.status_code in (200, 201, 202, 204) else "failed"
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return self.queue_action(action)
+        except:
+            return "failed"
+
+    def queue_action(self, action):
+        """Queue write action for replay once the connection returns"""
+        pending = self.get_cache()["pending"]
+        pending.append(action)
+        self.queued_ids.add(action["id"])
+        del pending[:-MAX_PENDING_ACTIONS]
+        self.mark_cache_dirty()
+        return "queued"
+
+    def replay_pending_actions(self):
+        """Replay write actions queued while offline.
+
+        Runs under its own lock with the queue re-read from disk, and writes
+        the shortened queue before releasing it, so concurrent revalidations
+        never send the same action twice.
+        """
+        cache = self.get_cache()
+        if not cache["pending"]:
+            return
+
+        # Whoever holds the lock is already replaying: leave the queue to it
+        lock_path = self.get_cache_file_path() + ".replay.lock"
+        if not acquire_lock(lock_path, timeout=0):
+            return
+        try:
+            self.merge_pending((self.read_json(self.get_cache_file_path()) or {}).get("pending"))
+            if not cache["pending"]:
+                return
+
+            access_token = self.get_valid_access_token()
+            if not access_token:
+                return
+
+            headers = {"Authorization": f"Bearer {access_token}"}
+            pending = list(cache["pending"])
+            while pending:
+                action = pending[0]
+                try:
+                    self.http_request(action["method"], f"{self.base_url}{action['path']}",
+                                      headers=headers, params=action["params"], json=action["body"])
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    break
+                except:
+                    pass
+                self.replayed_ids.add(self.action_id(pending.pop(0)))
+                os.utime(lock_path)  # Still replaying, not a stale lock
+
+            cache["pending"] = pending
+            self.mark_cache_dirty()
+            self.flush_cache()
+        finally:
+            release_lock(lock_path)
+
     def get_token_file_path(self):
         """Get path for storing tokens"""
         plugin_dir = os.path.dirname(os.path.abspath(__file__))
@@ -72,13 +1283,27 @@ class SpotifyPlugin:
         except:
             pass
 
-    def get_auth_url(self):
+    def get_token_url(self):
+        """Get OAuth token endpoint"""
+        return f"{self.auth_base_url}/api/token"
+
+    def create_pkce_pair(self):
+        """Create PKCE code verifier and S256 code challenge"""
+        code_verifier = secrets.token_urlsafe(64)
+        digest = hashlib.sha256(code_verifier.encode()).digest()
+        code_challenge = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+        return code_verifier, code_challenge
+
+    def get_auth_url(self, state="spotify_plugin", code_challenge=None):
         """Generate OAuth authorization URL"""
         scopes = [
             "user-modify-playback-state",
             "user-read-playback-state",
             "user-read-currently-playing",
-            "user-read-private"
+            "user-read-private",
+            "user-library-modify",
+            "user-library-read",
+            "playlist-read-private"
         ]
 
         params = {
@@ -86,63 +1311,53 @@ class SpotifyPlugin:
             "response_type": "code",
             "redirect_uri": self.redirect_uri,
             "scope": " ".join(scopes),
-            "state": "spotify_plugin"
+            "state": state
         }
+        if code_challenge:
+            params["code_challenge_method"] = "S256"
+            params["code_challenge"] = code_challenge
 
         query_string = "&".join([f"{k}={urllib.parse.quote(str(v))}" for k, v in params.items()])
-        return f"https://accounts.spotify.com/authorize?{query_string}"
-
-    def start_auth_server(self):
-        """Start local server for OAuth callback"""
-        class AuthHandler(http.server.BaseHTTPRequestHandler):
-            def __init__(self, plugin_instance):
-                self.plugin = plugin_instance
-                super().__init__()
-
-            def __call__(self, *args, **kwargs):
-                self.plugin = self.plugin
-                super().__init__(*args, **kwargs)
-
-            def do_GET(self):
-                parsed_url = urlparse(self.path)
-                if parsed_url.path == "/callback":
-                    query_params = parse_qs(parsed_url.query)
-
-                    if "code" in query_params:
-                        auth_code = query_params["code"][0]
-                        success = self.plugin.exchange_code_for_token(auth_code)
-
-                        if success:
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/html')
-                            self.end_headers()
-                            self.wfile.write(b"<h1>Success!</h1><p>You can close this window.</p>")
-                        else:
-                            self.send_response(400)
-                            self.send_header('Content-type', 'text/html')
-                            self.end_headers()
-                            self.wfile.write(b"<h1>Error!</h1><p>Failed to authorize.</p>")
-                    else:
-                        self.send_response(400)
-                        self.send_header('Content-type', 'text/html')
-                        self.end_headers()
-                        self.wfile.write(b"<h1>Error!</h1><p>No authorization code received.</p>")
-
-                self.plugin.server_should_stop = True
-
-            def log_message(self, format, *args):
-                pass  # Suppress logs
-
-        try:
-            handler = lambda *args, **kwargs: AuthHandler(self)(*args, **kwargs)
-            with socketserver.TCPServer(("", 8080), handler) as httpd:
-                self.server_should_stop = False
-                while not self.server_should_stop:
-                    httpd.handle_request()
+        return f"{self.auth_base_url}/authorize?{query_string}"
+
+    def start_auth_server(self, state, code_verifier):
+        """Start OAuth callback listener, or None if it cannot bind"""
+        def on_code(auth_code):
+            return self.exchange_code_for_token(auth_code, code_verifier)
+
+        try:
+            server = AuthCallbackServer(self.redirect_uri, state, on_code)
+        except OSError:
+            return None
+
+        # The token exchange must use the redirect URI actually bound
+        self.redirect_uri = server.redirect_uri
+        server.start()
+        return server
+
+    def run_authorization(self, timeout=AUTH_TIMEOUT, open_url=webbrowser.open):
+        """Run the full authorization code + PKCE flow.
+
+        Blocks until the callback arrives or the timeout expires; tokens are
+        written to the token store. open_url receives the authorization URL,
+        so the flow can be driven headless.
+        """
+        state = secrets.token_urlsafe(16)
+        code_verifier, code_challenge = self.create_pkce_pair()
+
+        server = self.start_auth_server(state, code_verifier)
+        if not server:
+            return False
+
+        try:
+            open_url(self.get_auth_url(state, code_challenge))
         except:
-            pass
+            server.stop()
+            return False
 
-    def exchange_code_for_token(self, auth_code):
+        return server.wait(timeout)
+
+    def exchange_code_for_token(self, auth_code, code_verifier=None):
         """Exchange authorization code for access token"""
         auth_header = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
 
@@ -156,9 +1371,12 @@ class SpotifyPlugin:
             "code": auth_code,
             "redirect_uri": self.redirect_uri
         }
+        if code_verifier:
+            data["client_id"] = self.client_id
+            data["code_verifier"] = code_verifier
 
         try:
-            response = requests.post("https://accounts.spotify.com/api/token", headers=headers, data=data)
+            response = self.http_request("POST", self.get_token_url(), headers=headers, data=data)
             if response.status_code == 200:
                 token_data = response.json()
                 self.access_token = token_data.get("access_token")
@@ -166,6 +1384,7 @@ class SpotifyPlugin:
                 expires_in = token_data.get("expires_in", 3600)
                 self.token_expires = datetime.now() + timedelta(seconds=expires_in)
                 self.save_tokens()
+                self.get_caches().fire("authorized")
                 return True
         except:
             pass
@@ -190,7 +1409,7 @@ class SpotifyPlugin:
         }
 
         try:
-            response = requests.post("https://accounts.spotify.com/api/token", headers=headers, data=data)
+            response = self.http_request("POST", self.get_token_url(), headers=headers, data=data)
             if response.status_code == 200:
                 token_data = response.json()
                 self.access_token = token_data.get("access_token")
@@ -199,6 +1418,7 @@ class SpotifyPlugin:
                 expires_in = token_data.get("expires_in", 3600)
                 self.token_expires = datetime.now() + timedelta(seconds=expires_in)
                 self.save_tokens()
+                self.get_caches().fire("token_refreshed")
                 return True
         except:
             pass
@@ -222,7 +1442,12 @@ class SpotifyPlugin:
         if self.search_token:
             return self.search_token
 
-        auth_url = "https://accounts.spotify.com/api/token"
+        tokens = self.get_caches()["tokens"]
+        self.search_token = tokens.get("search")
+        if self.search_token:
+            return self.search_token
+
+        auth_url = self.get_token_url()
         auth_header = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
 
         headers = {
@@ -233,10 +1458,13 @@ class SpotifyPlugin:
         data = {"grant_type": "client_credentials"}
 
         try:
-            response = requests.post(auth_url, headers=headers, data=data, timeout=5)
+            response = self.http_request("POST", auth_url, headers=headers, data=data)
             if response.status_code == 200:
                 token_data = response.json()
                 self.search_token = token_data.get("access_token")
+                # Shared with later invocations, minus a safety margin
+                expires_in = token_data.get("expires_in", 3600)
+                tokens.set("search", self.search_token, ttl=max(expires_in - 60, 60))
                 return self.search_token
         except:
             pass
@@ -247,19 +1475,37 @@ class SpotifyPlugin:
         """Get user's available Spotify devices"""
         access_token = self.get_valid_access_token()
         if not access_token:
-            return []
+            return self.get_stale_devices()
 
         headers = {"Authorization": f"Bearer {access_token}"}
 
         try:
-            response = requests.get(f"{self.base_url}/me/player/devices", headers=headers)
+            response = self.http_request("GET", f"{self.base_url}/me/player/devices", headers=headers)
             if response.status_code == 200:
                 data = response.json()
-                return data.get("devices", [])
+                devices = data.get("devices", [])
+                self.store_devices(devices)
+                return devices
         except:
             pass
 
-        return []
+        return self.get_stale_devices()
+
+    def store_devices(self, devices):
+        """Cache device list, invalidating player state if the active device changed"""
+        cache = self.get_caches()["devices"]
+        previous = cache.get("list") or []
+        active_ids = [[device.get("id") for device in device_list if device.get("is_active")]
+                      for device_list in (previous, devices)]
+        if previous and active_ids[0] != active_ids[1]:
+            self.get_caches().fire("device_changed")
+        cache.set("list", devices)
+
+    def get_stale_devices(self):
+        """Return last known device list, marked stale, while offline"""
+        if not self.is_offline():
+            return []
+        return [dict(device, is_stale=True) for device in self.get_caches()["devices"].get("list") or []]
 
     def start_playback(self, track_uri, device_id=None):
         """Start playback of specific track - THIS IS THE KEY METHOD"""
@@ -272,11 +1518,14 @@ class SpotifyPlugin:
             "Content-Type": "application/json"
         }
 
-        # Prepare playback data
-        data = {
-            "uris": [track_uri],
-            "position_ms": 0
-        }
+        # Prepare playback data; albums, artists and playlists are contexts
+        if track_uri.startswith(("spotify:track:", "spotify:episode:")):
+            data = {
+                "uris": [track_uri],
+                "position_ms": 0
+            }
+        else:
+            data = {"context_uri": track_uri}
 
         # Add device if specified
         params = {}
@@ -284,12 +1533,39 @@ class SpotifyPlugin:
             params["device_id"] = device_id
 
         try:
-            response = requests.put(f"{self.base_url}/me/player/play",
-                                  headers=headers, json=data, params=params)
+            response = self.http_request("PUT", f"{self.base_url}/me/player/play",
+                                         headers=headers, json=data, params=params)
             return response.status_code in (204, 202)
         except:
             return False
 
+    def get_current_track_id(self):
+        """Get ID of the currently playing track, last known one while offline"""
+        cache = self.get_caches()["player"]
+        access_token = self.get_valid_access_token()
+        if not access_token:
+            return cache.get("current_track") if self.is_offline() else None
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        try:
+            response = self.http_request("GET", f"{self.base_url}/me/player/currently-playing", headers=headers)
+            if response.status_code == 200:
+                item = response.json().get("item") or {}
+                cache.set("current_track", item.get("id"))
+                return item.get("id")
+            elif response.status_code == 204:
+                return None
+        except:
+            pass
+
+        return cache.get("current_track") if self.is_offline() else None
+
+    def queue_track(self, track_uri, query_str=None):
+        """Add track to the playback queue, deferred while offline"""
+        self.record_play(track_uri, query_str)
+        self.send_write_request("POST", "/me/player/queue", params={"uri": track_uri})
+
     def get_consistent_image_url(self, images):
         """Select the best image size for consistent display"""
         if not images:
@@ -313,6 +1589,14 @@ class SpotifyPlugin:
         return "spotify_premium_icon.png"
 
     def is_spotify_running(self):
+        """Check for the Spotify process, shared with concurrent invocations"""
+        try:
+            return self.get_coalescer().run("spotify_running", self.detect_spotify_process,
+                                            window=SPOTIFY_CHECK_WINDOW)
+        except:
+            return self.detect_spotify_process()
+
+    def detect_spotify_process(self):
         try:
             if platform.system() == 'Windows':
                 tasks = subprocess.check_output('tasklist', shell=True).decode()
@@ -403,7 +1687,9 @@ class SpotifyPlugin:
             {"emoji": "🎵", "command": "track", "description": "Search tracks (usage: sp track [name])"},
             {"emoji": "🎤", "command": "artist", "description": "Search artists (usage: sp artist [name])"},
 
-            {"emoji": "💿", "command": "album", "description": "Search albums (usage: sp album [name])"}
+            {"emoji": "💿", "command": "album", "description": "Search albums (usage: sp album [name])"},
+            {"emoji": "📃", "command": "playlist", "description": "Browse your playlists (usage: sp playlist [name]/[filter])"},
+            {"emoji": "📚", "command": "library", "description": "Browse your liked songs (usage: sp library [filter])"}
         ]
 
         results = []
@@ -427,124 +1713,507 @@ class SpotifyPlugin:
 
         return results
 
-    def search_tracks(self, query, limit=10):
-        """Search for tracks on Spotify with consistent large cover art"""
-        token = self.get_search_token()
+    def get_market(self):
+        """Get market used to narrow payloads: the configured code, else the user's own.
+
+        Returns (market, user_token); from_token needs a user access token, so
+        without one and without a configured market no market is sent.
+        """
+        market = self.market.strip().upper()
+        if market:
+            return market, None
+        if self.access_token or self.refresh_token:
+            access_token = self.get_valid_access_token()
+            if access_token:
+                return "from_token", access_token
+        return "", None
+
+    def parse_track(self, track):
+        """Build slim record from a track search item"""
+        artist_names = ", ".join([artist["name"] for artist in track["artists"]])
+        duration_ms = track.get("duration_ms", 0)
+        duration_min = duration_ms // 60000
+        duration_sec = (duration_ms % 60000) // 1000
+        album = track.get("album", {})
+
+        return SearchResult(
+            f"🎵 {track['name']}",
+            f"by {artist_names} • {duration_min}:{duration_sec:02d} • {album.get('name', '')}",
+            self.get_consistent_image_url(album.get("images", [])),
+            "play_track",
+            track["uri"],  # Use URI instead of external URL
+            name=track["name"],
+            popularity=track.get("popularity", 0)
+        )
+
+    def parse_artist(self, artist):
+        """Build slim record from an artist search item"""
+        followers = artist.get("followers", {}).get("total", 0)
+        followers_text = f"{followers:,} followers" if followers > 0 else "Artist"
+
+        return SearchResult(
+            f"🎤 {artist['name']}",
+            f"{followers_text} • {', '.join(artist.get('genres', ['Unknown'])[:2])}",
+            self.get_consistent_image_url(artist.get("images", [])),
+            "play_artist",
+            artist["uri"],
+            name=artist["name"],
+            popularity=artist.get("popularity", 0)
+        )
+
+    def parse_album(self, album):
+        """Build slim record from an album search item"""
+        artist_names = ", ".join([artist["name"] for artist in album["artists"]])
+        release_year = album.get("release_date", "")[:4] if album.get("release_date") else ""
+
+        return SearchResult(
+            f"💿 {album['name']}",
+            f"by {artist_names} • {release_year} • {album.get('total_tracks', 0)} tracks",
+            self.get_consistent_image_url(album.get("images", [])),
+            "play_album",
+            album["uri"],
+            name=album["name"],
+            popularity=album.get("popularity")
+        )
+
+    def search(self, query, types, limit):
+        """Run a single /search request for one or more types.
+
+        Returns a dict mapping each type to a list of SearchResult records.
+        The response body is decoded once and only the fields we display
+        are kept; setting a market drops the bulky available_markets lists.
+        While offline the last cached records are served, marked stale.
+        """
+        cache_key = f"{','.join(types)}:{limit}:{query.strip().lower()}"
+        if self.market.strip():
+            cache_key = f"{self.market.strip().upper()}:{cache_key}"
+        if self.is_offline():
+            return self.get_stale_search(cache_key, query)
+
+        if not self.force_refresh:
+            rows = self.get_caches()["search"].get(cache_key, max_age=SEARCH_TTL)
+            if rows is not None:
+                return self.rank_records(self.load_search(rows, stale=False))
+
+        market, user_token = self.get_market()
+        token = user_token or self.get_search_token()
         if not token:
-            return []
+            return self.get_stale_search(cache_key, query)
 
         headers = {"Authorization": f"Bearer {token}"}
-        params = {"q": query, "type": "track", "limit": limit}
+        params = {"q": query, "type": ",".join(types), "limit": limit}
+        if market:
+            params["market"] = market
+
+        parsers = {
+            "track": self.parse_track,
+            "artist": self.parse_artist,
+            "album": self.parse_album
+        }
 
         try:
-            response = requests.get(f"{self.base_url}/search", headers=headers, params=params, timeout=5)
+            response = self.http_request("GET", f"{self.base_url}/search", headers=headers, params=params)
             if response.status_code == 200:
-                data = response.json()
-                tracks = data.get("tracks", {}).get("items", [])
-
-                results = []
-                for track in tracks:
-                    artist_names = ", ".join([artist["name"] for artist in track["artists"]])
-                    duration_ms = track.get("duration_ms", 0)
-                    duration_min = duration_ms // 60000
-                    duration_sec = (duration_ms % 60000) // 1000
-
-                    album_images = track.get("album", {}).get("images", [])
-                    icon_path = self.get_consistent_image_url(album_images)
-
-                    results.append({
-                        "Title": f"🎵 {track['name']}",
-                        "SubTitle": f"by {artist_names} • {duration_min}:{duration_sec:02d} • {track['album']['name']}",
-
-                        "IcoPath": icon_path,
-                        "JsonRPCAction": {
-                            "method": "play_track",
-                            "parameters": [track["uri"]]  # Use URI instead of external URL
-                        }
-                    })
-                return results
+                data = json.loads(response.content)
+
+                records = {}
+                for search_type in types:
+                    parse = parsers[search_type]
+                    items = (data.get(search_type + "s") or {}).get("items") or []
+                    records[search_type] = [parse(item) for item in items if item]
+                self.store_search(cache_key, records)
+                return self.rank_records(records)
+            elif response.status_code == 401 and not user_token:
+                self.search_token = None
+                self.get_caches()["tokens"].discard("search")
         except:
             pass
 
-        return []
+        return self.get_stale_search(cache_key, query)
 
-    def search_artists(self, query, limit=8):
-        """Search for artists on Spotify with consistent large images"""
-        token = self.get_search_token()
-        if not token:
-            return []
+    def store_search(self, cache_key, records):
+        """Keep search records for reuse and offline use"""
+        self.get_caches()["search"].set(cache_key, {
+            search_type: [record.to_row() for record in type_records]
+            for search_type, type_records in records.items()
+        })
 
-        headers = {"Authorization": f"Bearer {token}"}
-        params = {"q": query, "type": "artist", "limit": limit}
+    def get_stale_search(self, cache_key, query):
+        """Return cached search records, marked stale, while offline"""
+        if not self.is_offline():
+            return {}
 
+        self.schedule_revalidation(query)
+        return self.load_search(self.get_caches()["search"].get(cache_key) or {}, stale=True)
+
+    def load_search(self, rows, stale):
+        """Rebuild search records from cached rows"""
+        return {
+            search_type: [SearchResult.from_row(row, stale, self.active_query) for row in type_rows]
+            for search_type, type_rows in rows.items()
+        }
+
+    def rank_records(self, records):
+        """Tag records with the active query and move often played ones up"""
+        history = self.get_history()
+        now = time.time()
+        for search_type, type_records in records.items():
+            for record in type_records:
+                record.query = self.active_query
+            # Stable sort keeps API order among equally scored items
+            type_records.sort(key=lambda record: -history.score("uris", record.uri, now))
+        return records
+
+    def show_cache_stats(self):
+        """Return one row per cache namespace with its effectiveness"""
+        caches = self.get_caches()
+        self.get_library_cache()
+        results = [{
+            "Title": f"🗄️ Cache: {caches.total_bytes() // 1024} KB of {caches.max_bytes // 1024} KB",
+            "SubTitle": "Shared memory cap across all namespaces",
+            "IcoPath": "spotify_premium_icon.png"
+        }]
+        for name, stats in caches.stats().items():
+            results.append({
+                "Title": f"{name}: {stats['entries']} entries, {stats['bytes'] // 1024} KB of {stats['max_bytes'] // 1024} KB",
+                "SubTitle": f"Hit rate {stats['hit_rate']:.0%} • {stats['hits']} hits • {stats['misses']} misses • {stats['evictions']} evictions",
+                "IcoPath": "spotify_premium_icon.png"
+            })
+        return results
+
+    def show_profiling(self):
+        """Return profiling status and toggle"""
+        enabled = os.path.exists(os.path.join(get_profile_dir(), "enabled"))
+        return [{
+            "Title": f"⏱️ Profiling {'on' if enabled else 'off'} - click to turn {'off' if enabled else 'on'}",
+            "SubTitle": f"Chrome traces (chrome://tracing, Perfetto) are written to {get_profile_dir()}",
+            "IcoPath": "spotify_premium_icon.png",
+            "JsonRPCAction": {
+                "method": "toggle_profiling",
+                "parameters": []
+            }
+        }]
+
+    def toggle_profiling(self):
+        """Turn per-invocation tracing on or off"""
+        marker = os.path.join(get_profile_dir(), "enabled")
         try:
-            response = requests.get(f"{self.base_url}/search", headers=headers, params=params, timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                artists = data.get("artists", {}).get("items", [])
-
-                results = []
-                for artist in artists:
-                    followers = artist.get("followers", {}).get("total", 0)
-                    followers_text = f"{followers:,} followers" if followers > 0 else "Artist"
-
-                    artist_images = artist.get("images", [])
-                    icon_path = self.get_consistent_image_url(artist_images)
-
-                    results.append({
-                        "Title": f"🎤 {artist['name']}",
-                        "SubTitle": f"{followers_text} • {', '.join(artist.get('genres', ['Unknown'])[:2])}",
-
-                        "IcoPath": icon_path,
-                        "JsonRPCAction": {
-                            "method": "play_artist",
-                            "parameters": [artist["uri"]]
-                        }
-                    })
-                return results
+            if os.path.exists(marker):
+                os.remove(marker)
+            else:
+                os.makedirs(get_profile_dir(), exist_ok=True)
+                open(marker, 'w').close()
         except:
             pass
 
-        return []
+    def search_tracks(self, query, limit=10):
+        """Search for tracks on Spotify with consistent large cover art"""
+        records = self.search(query, ("track",), limit).get("track", [])
+        return [record.to_result() for record in records]
+
+    def search_artists(self, query, limit=8):
+        """Search for artists on Spotify with consistent large images"""
+        records = self.search(query, ("artist",), limit).get("artist", [])
+        return [record.to_result() for record in records]
 
     def search_albums(self, query, limit=8):
         """Search for albums on Spotify with consistent large cover art"""
-        token = self.get_search_token()
-        if not token:
-            return []
+        records = self.search(query, ("album",), limit).get("album", [])
+        return [record.to_result() for record in records]
 
-        headers = {"Authorization": f"Bearer {token}"}
-        params = {"q": query, "type": "album", "limit": limit}
+    def fetch_page(self, url, headers, params):
+        """Fetch one page, waiting out rate limiting via Retry-After"""
+        for attempt in range(MAX_PAGE_RETRIES + 1):
+            try:
+                response = self.http_request("GET", url, headers=headers, params=params)
+            except:
+                return None
 
-        try:
-            response = requests.get(f"{self.base_url}/search", headers=headers, params=params, timeout=5)
             if response.status_code == 200:
-                data = response.json()
-                albums = data.get("albums", {}).get("items", [])
-
-                results = []
-                for album in albums:
-                    artist_names = ", ".join([artist["name"] for artist in album["artists"]])
-                    release_year = album.get("release_date", "")[:4] if album.get("release_date") else ""
-
-                    album_images = album.get("images", [])
-                    icon_path = self.get_consistent_image_url(album_images)
-
-                    results.append({
-                        "Title": f"💿 {album['name']}",
-                        "SubTitle": f"by {artist_names} • {release_year} • {album.get('total_tracks', 0)} tracks",
-
-                        "IcoPath": icon_path,
-                        "JsonRPCAction": {
-                            "method": "play_album",
-                            "parameters": [album["uri"]]
-                        }
-                    })
-                return results
-        except:
-            pass
+                return json.loads(response.content)
+            if response.status_code != 429 or attempt == MAX_PAGE_RETRIES:
+                return None
 
-        return []
+            try:
+                delay = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                delay = 1
+            time.sleep(min(delay, 5))
+
+        return None
+
+    def fetch_pages(self, url, headers, params=None, page_size=50):
+        """Yield (offset, items, page_count) for every page of a paged endpoint.
+
+        The first page gives the total; the remaining pages are fetched
+        PAGE_CONCURRENCY at a time and yielded in arrival order. Closing
+        the generator cancels pages not yet started.
+        """
+        params = dict(params or {}, limit=page_size)
+        first = self.fetch_page(url, headers, dict(params, offset=0))
+        if first is None:
+            return
+
+        offsets = range(page_size, min(first.get("total") or 0, MAX_PAGED_ITEMS), page_size)
+        page_count = len(offsets) + 1
+        yield 0, first.get("items") or [], page_count
+        if not offsets:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY)
+        futures = {
+            executor.submit(self.fetch_page, url, headers, dict(params, offset=offset)): offset
+            for offset in offsets
+        }
+        try:
+            for future in as_completed(futures):
+                page = future.result()
+                if page is not None:
+                    yield futures[future], page.get("items") or [], page_count
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def collect_rows(self, pages, parse, page_size, needed=None):
+        """Gather parsed rows from fetch_pages in position order.
+
+        Returns (rows, complete). With needed set, stops consuming pages
+        once the first needed rows have arrived.
+        """
+        by_offset = {}
+        page_count = 0
+        for offset, items, page_count in pages:
+            by_offset[offset] = [row for row in (parse(item) for item in items if item) if row]
+
+            if needed is not None:
+                covered, next_offset = 0, 0
+                while next_offset in by_offset:
+                    covered += len(by_offset[next_offset])
+                    next_offset += page_size
+                if covered >= needed:
+                    pages.close()
+                    break
+
+        rows = [row for offset in sorted(by_offset) for row in by_offset[offset]]
+        return rows, page_count > 0 and len(by_offset) == page_count
+
+    def parse_playlist(self, playlist):
+        """Build slim playlist summary"""
+        return {
+            "name": playlist.get("name") or "",
+            "id": playlist["id"],
+            "uri": playlist["uri"],
+            "snapshot_id": playlist.get("snapshot_id"),
+            "owner": (playlist.get("owner") or {}).get("display_name") or "",
+            "total": (playlist.get("tracks") or {}).get("total", 0),
+            "icon": self.get_consistent_image_url(playlist.get("images") or [])
+        }
+
+    def parse_saved_track(self, item):
+        """Build slim row from a playlist or library item, skipping episodes"""
+        track = item.get("track")
+        if not track or track.get("type", "track") != "track" or not track.get("uri"):
+            return None
+        return self.parse_track(track).to_row()
+
+    def get_playlists(self, headers):
+        """Get the user's playlists, cached for PLAYLISTS_TTL"""
+        cache = self.get_library_cache()
+        playlists = cache.get("playlists", max_age=PLAYLISTS_TTL)
+        self.playlists_fresh = playlists is not None
+        if playlists is not None or self.is_offline():
+            return playlists or cache.get("playlists") or []
+
+        pages = self.fetch_pages(f"{self.base_url}/me/playlists", headers)
+        playlists, complete = self.collect_rows(pages, self.parse_playlist, 50)
+        if complete:
+            cache.set("playlists", playlists)
+            self.playlists_fresh = True
+        return playlists or cache.get("playlists") or []
+
+    def get_playlist_tracks(self, playlist, headers):
+        """Get playlist track rows, re-downloaded only when its snapshot changed.
+
+        The snapshot from a fresh playlist list is trusted as is; the network
+        is only asked for the current snapshot when that list is stale.
+        """
+        cache = self.get_library_cache()
+        cache_key = f"playlist:{playlist['id']}"
+        cached = cache.get(cache_key)
+        snapshot_id = playlist.get("snapshot_id")
+
+        if cached and self.playlists_fresh:
+            if cached["snapshot_id"] == snapshot_id:
+                return cached["rows"]
+        elif cached:
+            if self.is_offline():
+                return cached["rows"]
+            current = self.fetch_page(f"{self.base_url}/playlists/{playlist['id']}",
+                                      headers, {"fields": "snapshot_id"})
+            if current is None or current.get("snapshot_id") == cached["snapshot_id"]:
+                return cached["rows"]
+            snapshot_id = current.get("snapshot_id")
+
+        pages = self.fetch_pages(f"{self.base_url}/playlists/{playlist['id']}/tracks",
+                                 headers, {"fields": PLAYLIST_TRACK_FIELDS}, 100)
+        rows, complete = self.collect_rows(pages, self.parse_saved_track, 100)
+        if complete:
+            cache.set(cache_key, {"snapshot_id": snapshot_id, "rows": rows})
+            return rows
+        return rows or (cached or {}).get("rows", [])
+
+    def get_library_tracks(self, headers, needed=None):
+        """Get liked song rows; with needed set only the first rows are fetched"""
+        cache = self.get_library_cache()
+        rows = cache.get("saved_tracks", max_age=LIBRARY_TTL)
+        if rows is not None or self.is_offline():
+            return rows or cache.get("saved_tracks") or []
+
+        # The user token is already in headers, so from_token always applies
+        params = {"market": self.market.strip().upper() or "from_token"}
+
+        pages = self.fetch_pages(f"{self.base_url}/me/tracks", headers, params)
+        rows, complete = self.collect_rows(pages, self.parse_saved_track, 50, needed)
+        if complete:
+            cache.set("saved_tracks", rows)
+        return rows
+
+    def track_rows_to_results(self, rows, track_filter):
+        """Convert cached track rows to results, filtered and capped"""
+        track_filter = track_filter.strip().lower()
+        stale = self.is_offline()
+        results = []
+        for row in rows:
+            record = SearchResult.from_row(row, stale, self.active_query)
+            if track_filter and track_filter not in f"{record.title} {record.subtitle}".lower():
+                continue
+            results.append(record.to_result())
+            if len(results) >= MAX_BROWSE_RESULTS:
+                break
+        return results
+
+    def auth_required(self):
+        """Result asking the user to authorize first"""
+        return [{
+            "Title": "🔐 Authorize Spotify",
+            "SubTitle": "Required to browse your playlists and library - click to authenticate",
+            "IcoPath": "spotify_premium_icon.png",
+            "JsonRPCAction": {
+                "method": "authorize_spotify",
+                "parameters": []
+            }
+        }]
+
+    def browse_playlists(self, args):
+        """List playlists, or the tracks of one with 'name/filter'"""
+        access_token = self.get_valid_access_token()
+        if not access_token:
+            return self.auth_required()
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+        playlists = self.get_playlists(headers)
+        # Split on the last slash so playlist names may contain one
+        name, opened, track_filter = args.rpartition("/") if "/" in args else (args, "", "")
+        name = name.strip()
+
+        if opened:
+            playlist = next((p for p in playlists if p["name"].lower() == name.lower()), None)
+            if not playlist:
+                return [{
+                    "Title": f"📃 No playlist named '{name}'",
+                    "SubTitle": "Usage: sp playlist [name]/[filter]",
+                    "IcoPath": "spotify_premium_icon.png"
+                }]
+
+            results = [{
+                "Title": f"▶️ Play {playlist['name']}",
+                "SubTitle": f"{playlist['total']} tracks • by {playlist['owner']}",
+                "IcoPath": playlist["icon"],
+                "JsonRPCAction": {
+                    "method": "play_playlist",
+                    "parameters": [playlist["uri"], self.active_query]
+                }
+            }]
+            rows = self.get_playlist_tracks(playlist, headers)
+            return results + self.track_rows_to_results(rows, track_filter)
+
+        results = []
+        for playlist in playlists:
+            if name and name.lower() not in playlist["name"].lower():
+                continue
+            results.append({
+                "Title": f"📃 {playlist['name']}",
+                "SubTitle": f"{playlist['total']} tracks • by {playlist['owner']} • Enter to open",
+                "IcoPath": playlist["icon"],
+                "JsonRPCAction": {
+                    "method": "Flow.Launcher.ChangeQuery",
+                    "parameters": [f"{ACTION_KEYWORD} playlist {playlist['name']}/", False],
+                    "dontHideAfterAction": True
+                }
+            })
+            if len(results) >= MAX_BROWSE_RESULTS:
+                break
+
+        return results or [{
+            "Title": "📃 No playlists found" + (f" for '{name}'" if name else ""),
+            "SubTitle": "Usage: sp playlist [name]/[filter]",
+            "IcoPath": "spotify_premium_icon.png"
+        }]
+
+    def browse_library(self, args):
+        """List liked songs, optionally filtered"""
+        access_token = self.get_valid_access_token()
+        if not access_token:
+            return self.auth_required()
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+        # Unfiltered views only show the first rows, so stop paging early
+        rows = self.get_library_tracks(headers, None if args.strip() else MAX_BROWSE_RESULTS)
+        return self.track_rows_to_results(rows, args) or [{
+            "Title": "📚 No liked songs found" + (f" for '{args.strip()}'" if args.strip() else ""),
+            "SubTitle": "Usage: sp library [filter]",
+            "IcoPath": "spotify_premium_icon.png"
+        }]
+
+    def browse_devices(self):
+        """List devices to transfer playback to; last known ones while offline"""
+        devices = self.get_available_devices()
+        if not devices and not self.is_offline() and not self.get_valid_access_token():
+            return self.auth_required()
+
+        icons = {"computer": "💻", "smartphone": "📱", "speaker": "🔊", "tv": "📺"}
+        results = []
+        for device in devices:
+            if device.get("is_active"):
+                status = "Last active" if device.get("is_stale") else "▶️ Active"
+            else:
+                status = "Enter to transfer playback"
+            subtitle = f"{device.get('type', 'Device')} • {status}"
+            if device.get("volume_percent") is not None:
+                subtitle += f" • 🔊 {device['volume_percent']}%"
+            if device.get("is_stale"):
+                subtitle = f"📴 Offline • last known • {subtitle}"
+            results.append({
+                "Title": f"{icons.get(str(device.get('type')).lower(), '🎧')} {device.get('name', 'Unknown device')}",
+                "SubTitle": subtitle,
+                "IcoPath": "spotify_premium_icon.png",
+                "JsonRPCAction": {
+                    "method": "transfer_playback",
+                    "parameters": [device.get("id")]
+                }
+            })
+
+        return results or [{
+            "Title": "📱 No devices found",
+            "SubTitle": "Open Spotify on a device, then try again",
+            "IcoPath": "spotify_premium_icon.png"
+        }]
+
+    def transfer_playback(self, device_id):
+        """Move playback to another device, queued while offline"""
+        if self.send_write_request("PUT", "/me/player", body={"device_ids": [device_id]}) == "sent":
+            self.get_caches().fire("device_changed")
 
     def query(self, query_str):
         """Main query handler"""
@@ -555,8 +2224,11 @@ class SpotifyPlugin:
         else:
             query_str = str(query_str).strip()
 
+        self.active_query = query_str
         parts = query_str.split() if query_str else []
         if not parts:
+            # User just opened the plugin: good moment to warm caches
+            self.schedule_prefetch()
             spotify_status = "🟢 Running" if self.is_spotify_running() else "🔴 Not Running"
             auth_status = "🔐 Authorized" if self.get_valid_access_token() else "❌ Not Authorized"
 
@@ -630,6 +2302,32 @@ class SpotifyPlugin:
                         "IcoPath": "spotify_premium_icon.png"
                     }]
 
+            elif command == "debug":
+                if args.lower() == "cache":
+                    return self.show_cache_stats()
+                elif args.lower() == "profile":
+                    return self.show_profiling()
+                return [{
+                    "Title": "🛠️ Debug",
+                    "SubTitle": "Usage: sp debug cache | sp debug profile",
+                    "IcoPath": "spotify_premium_icon.png"
+                }]
+
+            elif command == "playlist":
+                return self.browse_playlists(args)
+
+            elif command == "library":
+                return self.browse_library(args)
+
+            elif command == "device":
+                return self.browse_devices()
+
+            elif command == "queue" and args:
+                records = self.search(args, ("track",), 10).get("track", [])
+                for record in records:
+                    record.method = "queue_track"
+                return [record.to_result() for record in records]
+
             elif command == "album":
                 if args:
                     return self.search_albums(args)
@@ -665,16 +2363,20 @@ class SpotifyPlugin:
 
         else:
             # General search
-            all_results = []
-            track_results = self.search_tracks(query_str, 5)
-            all_results.extend(track_results)
-            artist_results = self.search_artists(query_str, 3)
-            all_results.extend(artist_results)
-            album_results = self.search_albums(query_str, 3)
-            all_results.extend(album_results)
+            # One request for all types, then rank the merged set locally
+            records = self.search(query_str, ("track", "artist", "album"), RANK_CANDIDATES)
+            merged = [record for type_records in records.values() for record in type_records]
+            ranker = ResultRanker(self.get_history(), top_k=self.rank_top_k)
+            all_results = [record.to_result() for record in ranker.rank(merged, query_str)]
 
             if all_results:
                 return all_results
+            elif self.is_offline():
+                return [{
+                    "Title": f"📴 Offline - no cached results for '{query_str}'",
+                    "SubTitle": "Results will be available once the connection returns",
+                    "IcoPath": "spotify_premium_icon.png"
+                }]
             else:
                 return [{
                     "Title": f"🔍 No results found for '{query_str}'",
@@ -707,7 +2409,15 @@ class SpotifyPlugin:
         }
 
         # Execute the actual command
-        if command in ['play', 'pause', 'next', 'previous', 'last']:
+        status = "sent"
+        if command in ['like', 'unlike']:
+            track_id = self.get_current_track_id()
+            if track_id:
+                method = "PUT" if command == 'like' else "DELETE"
+                status = self.send_write_request(method, "/me/tracks", params={"ids": track_id})
+            else:
+                status = "failed"
+        elif command in ['play', 'pause', 'next', 'previous', 'last']:
             self.send_media_key(command)
         elif command == 'shuffle':
             try:
@@ -725,6 +2435,19 @@ class SpotifyPlugin:
                 pass
 
         message = success_messages.get(command, f'Executing {command}')
+        if status == "queued":
+            return [{
+                "Title": "📴 Offline - Command Queued",
+                "SubTitle": f"{message} once the connection returns",
+                "IcoPath": "spotify_premium_icon.png"
+            }]
+        elif status == "failed":
+            return [{
+                "Title": "❌ Command Failed",
+                "SubTitle": message,
+                "IcoPath": "spotify_premium_icon.png"
+            }]
+
         return [{
             "Title": "✅ Command Executed",
             "SubTitle": message,
@@ -734,13 +2457,9 @@ class SpotifyPlugin:
     def authorize_spotify(self):
         """Start OAuth authorization process"""
         try:
-            auth_url = self.get_auth_url()
-            webbrowser.open(auth_url)
-
-            # Start server in a separate thread
-            server_thread = threading.Thread(target=self.start_auth_server)
-            server_thread.daemon = True
-            server_thread.start()
+            # The callback listener must outlive this short-lived process
+            if not self.spawn_background("run_authorization", []):
+                raise RuntimeError("Could not start authorization listener")
 
             return [{
                 "Title": "🔐 Authorization Started",
@@ -754,8 +2473,18 @@ class SpotifyPlugin:
                 "IcoPath": "spotify_premium_icon.png"
             }]
 
-    def play_track(self, track_uri):
+    def record_play(self, uri, query_str=None):
+        """Record played URI and the query that found it"""
+        history = self.get_history()
+        history.record("uris", uri)
+        if query_str:
+            history.record("queries", query_str)
+        self.mark_cache_dirty()
+
+    def play_track(self, track_uri, query_str=None):
         """Play specific track using Spotify Web API"""
+        self.record_play(track_uri, query_str)
+
         # Ensure Spotify is running
         self.launch_spotify()
 
@@ -790,13 +2519,17 @@ class SpotifyPlugin:
             webbrowser.open(f"https://open.spotify.com/{track_uri.replace(':', '/').replace('spotify/', '')}")
 
 
-    def play_artist(self, artist_uri):
+    def play_artist(self, artist_uri, query_str=None):
         """Play artist using Web API or fallback"""
-        self.play_track(artist_uri)
+        self.play_track(artist_uri, query_str)
 
-    def play_album(self, album_uri):
+    def play_album(self, album_uri, query_str=None):
         """Play album using Web API or fallback"""
-        self.play_track(album_uri)
+        self.play_track(album_uri, query_str)
+
+    def play_playlist(self, playlist_uri, query_str=None):
+        """Play playlist using Web API or fallback"""
+        self.play_track(playlist_uri, query_str)
 
     def launch_spotify_app(self):
         """Launch Spotify and return confirmation"""
@@ -816,6 +2549,8 @@ class SpotifyPlugin:
 
 def main():
     """Main entry point"""
+    start = time.perf_counter()
+    tracer = start_profiling()
     plugin = SpotifyPlugin()
 
     try:
@@ -823,32 +2558,34 @@ def main():
             request = json.loads(sys.argv[1])
             method = request.get("method", "")
             parameters = request.get("parameters", [])
+            if tracer:
+                tracer.label = method
 
             if method == "query":
                 query_param = parameters if parameters else ""
                 results = plugin.query(query_param)
-                print(json.dumps({"result": results}))
+                emit_results(results)
 
             elif method == "show_controls":
                 controls_results = plugin.show_controls()
-                print(json.dumps({"result": controls_results}))
+                emit_results(controls_results)
                 return
 
             elif method == "execute_command":
-                command = parameters if parameters else ""
-                value = parameters[11] if len(parameters) > 1 else None
+                command = parameters[0] if parameters else ""
+                value = parameters[1] if len(parameters) > 1 else None
                 command_results = plugin.execute_command(command, value)
-                print(json.dumps({"result": command_results}))
+                emit_results(command_results)
                 return
 
             elif method == "authorize_spotify":
                 auth_results = plugin.authorize_spotify()
-                print(json.dumps({"result": auth_results}))
+                emit_results(auth_results)
                 return
 
             elif method == "launch_spotify_app":
                 launch_results = plugin.launch_spotify_app()
-                print(json.dumps({"result": launch_results}))
+                emit_results(launch_results)
                 return
 
             elif hasattr(plugin, method):
@@ -859,7 +2596,7 @@ def main():
                     method_func()
         else:
             results = plugin.query("")
-            print(json.dumps({"result": results}))
+            emit_results(results)
 
     except Exception as e:
         error_result = [{
@@ -867,7 +2604,14 @@ def main():
             "SubTitle": f"Error: {str(e)}",
             "IcoPath": "spotify_premium_icon.png"
         }]
-        print(json.dumps({"result": error_result}))
+        emit_results(error_result)
+
+    finally:
+        # Results are already printed; persist caches for the next invocation
+        sys.stdout.flush()
+        plugin.flush_cache()
+        if tracer:
+            tracer.finish(start)
 
 if __name__ == "__main__":
     main()
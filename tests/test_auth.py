@@ -0,0 +1,121 @@
+"""Headless authorization flow against a local mock Spotify accounts server"""
+import base64
+import hashlib
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.request
+from unittest import mock
+from urllib.parse import urlparse, parse_qs, urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+class MockAccountsHandler(http.server.BaseHTTPRequestHandler):
+    """Redirects /authorize straight back with a code and verifies PKCE on /api/token"""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        self.server.authorize_params = query
+        location = query["redirect_uri"][0] + "?" + urlencode({"code": "CODE", "state": query["state"][0]})
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.end_headers()
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        self.server.token_params = body
+        challenge = self.server.authorize_params["code_challenge"][0]
+        digest = hashlib.sha256(body["code_verifier"][0].encode()).digest()
+        valid = (base64.urlsafe_b64encode(digest).decode().rstrip("=") == challenge
+                 and body["code"][0] == "CODE"
+                 and body["redirect_uri"][0] == self.server.authorize_params["redirect_uri"][0])
+
+        content = json.dumps({"access_token": "ACCESS", "refresh_token": "REFRESH", "expires_in": 3600}).encode()
+        self.send_response(200 if valid else 400)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class AuthorizationFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.accounts = http.server.HTTPServer(("127.0.0.1", 0), MockAccountsHandler)
+        self.accounts.authorize_params = None
+        self.accounts.token_params = None
+        threading.Thread(target=self.accounts.serve_forever, daemon=True).start()
+
+        # Keep tokens, caches and in-flight results out of the plugin directory
+        self.plugin_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(main, "__file__", os.path.join(self.plugin_dir.name, "main.py"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.plugin = main.SpotifyPlugin()
+        self.plugin.auth_base_url = f"http://127.0.0.1:{self.accounts.server_address[1]}"
+
+    def tearDown(self):
+        self.accounts.shutdown()
+        self.accounts.server_close()
+        self.plugin_dir.cleanup()
+
+    def follow(self, url):
+        """Act as the browser: follow the redirect chain in the background"""
+        threading.Thread(target=lambda: urllib.request.urlopen(url, timeout=5).read(), daemon=True).start()
+
+    def authorize(self):
+        return self.plugin.run_authorization(timeout=5, open_url=self.follow)
+
+    def test_authorizes_and_stores_tokens(self):
+        self.assertTrue(self.authorize())
+        self.assertEqual(self.plugin.access_token, "ACCESS")
+        self.assertEqual(self.plugin.refresh_token, "REFRESH")
+        self.assertEqual(self.accounts.token_params["grant_type"], ["authorization_code"])
+
+        with open(self.plugin.get_token_file_path(), "r") as f:
+            self.assertEqual(json.load(f)["refresh_token"], "REFRESH")
+
+    def test_authorizes_while_marked_offline(self):
+        self.plugin.mark_offline()
+        self.assertTrue(self.authorize())
+        self.assertEqual(self.plugin.access_token, "ACCESS")
+        self.assertFalse(self.plugin.is_offline())
+
+    def test_redirect_uses_loopback_ip(self):
+        self.plugin.redirect_uri = "http://localhost:8080/callback"
+        self.assertTrue(self.authorize())
+        redirect = urlparse(self.accounts.authorize_params["redirect_uri"][0])
+        self.assertEqual(redirect.hostname, "127.0.0.1")
+
+    def test_does_not_reuse_taken_port(self):
+        self.assertFalse(main.AuthCallbackServer.allow_reuse_address)
+
+    def test_falls_back_to_free_port(self):
+        try:
+            blocker = http.server.HTTPServer(("127.0.0.1", 8080), MockAccountsHandler)
+        except OSError:
+            blocker = None  # Already taken by something else, which is just as good
+        try:
+            self.assertTrue(self.authorize())
+        finally:
+            if blocker:
+                blocker.server_close()
+
+        redirect = urlparse(self.accounts.authorize_params["redirect_uri"][0])
+        self.assertEqual(redirect.hostname, "127.0.0.1")
+        self.assertNotEqual(redirect.port, 8080)
+        self.assertEqual(self.accounts.token_params["redirect_uri"][0], redirect.geturl())
+
+    def test_times_out_without_callback(self):
+        self.assertFalse(self.plugin.run_authorization(timeout=0.2, open_url=lambda url: None))
+        self.assertIsNone(self.accounts.token_params)
+
+if __name__ == "__main__":
+    unittest.main()
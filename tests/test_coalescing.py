@@ -0,0 +1,192 @@
+"""Work shared between concurrent plugin processes: coalesced requests and cache merges"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+class RequestCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.key = "key"
+        self.lock_path = os.path.join(self.directory.name, "key.lock")
+        self.result_path = os.path.join(self.directory.name, "key.json")
+
+    def coalescer(self):
+        return main.RequestCoalescer(self.directory.name)
+
+    def start_leader(self, producer, **kwargs):
+        """Run producer as the lock holder on another thread, returning once it holds the lock"""
+        started = threading.Event()
+        outcome = {}
+
+        def produce():
+            started.set()
+            time.sleep(0.2)
+            return producer()
+
+        def lead():
+            try:
+                outcome["value"] = self.coalescer().run(self.key, produce, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=lead)
+        thread.start()
+        self.assertTrue(started.wait(2))
+        return thread, outcome
+
+    def test_waiter_receives_leader_value(self):
+        thread, outcome = self.start_leader(lambda: {"status": 200})
+        follower = mock.Mock(return_value={"status": 500})
+
+        self.assertEqual(self.coalescer().run(self.key, follower), {"status": 200})
+        thread.join()
+        follower.assert_not_called()
+        self.assertEqual(outcome["value"], {"status": 200})
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_result_reused_within_window(self):
+        self.coalescer().run(self.key, lambda: 1)
+        follower = mock.Mock(return_value=2)
+        self.assertEqual(self.coalescer().run(self.key, follower), 1)
+        follower.assert_not_called()
+
+    def test_connection_error_shared_as_offline(self):
+        def fail():
+            raise requests.exceptions.ConnectionError("no route")
+
+        thread, outcome = self.start_leader(fail)
+        follower = mock.Mock(return_value=1)
+
+        with self.assertRaises(main.OfflineError):
+            self.coalescer().run(self.key, follower)
+        thread.join()
+        follower.assert_not_called()
+        self.assertIsInstance(outcome["error"], requests.exceptions.ConnectionError)
+
+    def test_unkept_result_reaches_waiter_then_is_deleted(self):
+        thread, outcome = self.start_leader(lambda: "token", window=0, keep_result=False)
+
+        self.assertEqual(self.coalescer().run(self.key, lambda: "own", window=0, keep_result=False), "token")
+        thread.join()
+        self.assertEqual(outcome["value"], "token")
+        self.assertFalse(os.path.exists(self.result_path))
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_stale_lock_is_taken_over(self):
+        os.close(os.open(self.lock_path, os.O_CREAT | os.O_WRONLY))
+        old = time.time() - main.LOCK_STALE - 1
+        os.utime(self.lock_path, (old, old))
+
+        self.assertEqual(self.coalescer().run(self.key, lambda: 3), 3)
+
+class CacheMergeTest(unittest.TestCase):
+    def namespace(self, data=None):
+        return main.CacheNamespace("search", 64 * 1024, 3600, data=data)
+
+    def test_merge_adopts_entries_from_other_processes(self):
+        ours = self.namespace()
+        theirs = self.namespace()
+        theirs.set("b", 2)
+
+        ours.set("a", 1)
+        ours.merge(theirs.to_dict())
+        self.assertEqual((ours.get("a"), ours.get("b")), (1, 2))
+
+    def test_merge_does_not_revive_discarded_entries(self):
+        disk = self.namespace()
+        disk.set("a", 1)
+        disk.set("b", 2)
+        data = disk.to_dict()
+
+        ours = self.namespace(data)
+        ours.discard("a")
+        ours.merge(data)
+        self.assertIsNone(ours.get("a"))
+        self.assertEqual(ours.get("b"), 2)
+
+    def test_merge_does_not_revive_cleared_entries(self):
+        disk = self.namespace()
+        disk.set("a", 1)
+        data = disk.to_dict()
+
+        ours = self.namespace(data)
+        ours.clear()
+        ours.merge(data)
+        self.assertEqual(ours.stats()["entries"], 0)
+
+    def test_merge_keeps_newer_value(self):
+        older = self.namespace()
+        older.set("a", "old")
+        data = older.to_dict()
+
+        ours = self.namespace(data)
+        time.sleep(0.01)
+        ours.set("a", "new")
+        ours.merge(data)
+        self.assertEqual(ours.get("a"), "new")
+
+    def test_usage_counters_add_up(self):
+        ours = self.namespace()
+        theirs = self.namespace()
+        ours.get("a")
+        theirs.get("b")
+
+        usage = ours.merge_usage(None)
+        usage = theirs.merge_usage(usage)
+        self.assertEqual((usage["hits"], usage["misses"]), (0, 2))
+
+class PendingMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.plugin_dir.cleanup)
+        patcher = mock.patch.object(main, "__file__", os.path.join(self.plugin_dir.name, "main.py"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def action(self, action_id):
+        return {"id": action_id, "method": "POST", "path": "/me/player/queue", "params": {}, "body": None}
+
+    def test_replayed_actions_are_not_revived(self):
+        writer = main.SpotifyPlugin()
+        writer.queue_action(self.action("a"))
+        writer.flush_cache()
+
+        # A process that loaded the queue before it was replayed elsewhere
+        stale = main.SpotifyPlugin()
+        stale.get_cache()
+
+        replayer = main.SpotifyPlugin()
+        replayer.get_cache()
+        replayer.replayed_ids.add("a")
+        replayer.get_cache()["pending"] = []
+        replayer.mark_cache_dirty()
+        replayer.flush_cache()
+
+        stale.queue_action(self.action("b"))
+        stale.flush_cache()
+
+        self.assertEqual([action["id"] for action in main.SpotifyPlugin().get_cache()["pending"]], ["b"])
+
+    def test_actions_queued_concurrently_are_kept(self):
+        first = main.SpotifyPlugin()
+        second = main.SpotifyPlugin()
+        first.queue_action(self.action("a"))
+        second.queue_action(self.action("b"))
+        first.flush_cache()
+        second.flush_cache()
+
+        pending = main.SpotifyPlugin().get_cache()["pending"]
+        self.assertEqual(sorted(action["id"] for action in pending), ["a", "b"])
+
+if __name__ == "__main__":
+    unittest.main()